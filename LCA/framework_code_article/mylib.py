@@ -3,23 +3,372 @@ import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import math
-from brightway2 import *
+import os
+import sqlite3
+import hashlib
+import time
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from scipy.special import gamma
+import importlib.util
+try:
+    from brightway2 import *
+    from bw2data.backends.peewee import ActivityDataset, ExchangeDataset
+    from bw2data.backends.peewee.proxies import Exchange
+except ImportError: # offline use on exported matrices (MatrixLCA.load)
+    pass
 
 
 def aep_rayleigh(v_mu,power_curve):
-    p=power_curve.Pdc
-    v=power_curve.Vw
-    F=1-np.exp(-np.pi/(4*v_mu**2)*np.power(v,2)) # Rayleigh distribution
-    sum=0
-    for x in range(1,len(p)-1):
-        bin_energy=(F[x]-F[x-1])*(p[x-1]+p[x])/2
-        sum=sum+bin_energy
-    aep=8760*sum # annual energy production  
-    return aep
+    # annual energy production (Wh), v_mu can be a scalar or an array of any shape
+    return aep_batch(v_mu,power_curve)
+
+def bin_weights(power_curve):
+    # bin rule of the AEP written on the bin edges (summation by parts):
+    # sum_x (F[x]-F[x-1])*(p[x-1]+p[x])/2 = sum_j w[j]*exp(-(v[j]/c)**k) with F=1-exp(-(v/c)**k)
+    # the last point of the power curve closes the last bin but is not integrated (x < len(p)-1)
+    p=np.asarray(power_curve.Pdc,dtype=float)
+    v=np.asarray(power_curve.Vw,dtype=float)
+    n=len(p)
+    mid=(p[:n-2]+p[1:n-1])/2 # power of bins x=1..n-2
+    w=np.zeros(n-1)
+    w[:n-2]+=mid
+    w[1:]-=mid
+    return v[:n-1],w
+
+def stack_power_curves(power_curves):
+    # edges and weights of several power curves padded to a (curves x edges) array
+    # padded edges repeat the last speed of the curve with a zero weight so they never contribute
+    edges=[bin_weights(pc) for pc in power_curves]
+    n=max(len(v) for v,w in edges)
+    v=np.zeros((len(edges),n))
+    w=np.zeros((len(edges),n))
+    for c,(vc,wc) in enumerate(edges):
+        v[c,:]=vc[-1]
+        v[c,:len(vc)]=vc
+        w[c,:len(wc)]=wc
+    return v,w
+
+def aep_batch(v_mu,power_curves,chunk_size=65536):
+    # batched Rayleigh AEP (Wh), same bin rule as the former per-bin loop of aep_rayleigh
+    # v_mu : array of mean wind speeds at hub height, any shape
+    # power_curves : one power curve (Vw, Pdc) or a list of power curves
+    # returns an array of shape v_mu.shape for one curve, v_mu.shape+(n_curves,) for a list
+    single=not isinstance(power_curves,(list,tuple))
+    v,w=stack_power_curves([power_curves] if single else power_curves)
+    v_mu=np.asarray(v_mu,dtype=float)
+    a=-np.pi/4*v**2 # Rayleigh distribution exponent per edge, divided by v_mu**2 below
+    inv=1/v_mu.ravel()**2
+    aep=np.empty((inv.size,len(w)))
+    for s in range(0,inv.size,chunk_size): # chunks bound the (speeds x curves x edges) temporary
+        e=np.exp(inv[s:s+chunk_size,None,None]*a)
+        np.einsum('ncb,cb->nc',e,w,out=aep[s:s+chunk_size])
+    aep*=8760 # annual energy production
+    aep=aep.reshape(v_mu.shape+(len(w),))
+    if single:
+        aep=aep[...,0]
+    return aep[()] # numpy scalar for a scalar v_mu
+
+def aep_weibull(v_mu,k,power_curves,chunk_size=65536):
+    # batched Weibull AEP (Wh) with shape factor k, same bin rule as aep_batch (k=2 is the Rayleigh case)
+    # v_mu and k are broadcast together, e.g. a (v_mu x 1) column against a (1 x k) row or two rasters
+    # F(V)=1-exp(-(V/c)**k) with the scale c=v_mu/gamma(1+1/k)
+    single=not isinstance(power_curves,(list,tuple))
+    v,w=stack_power_curves([power_curves] if single else power_curves)
+    with np.errstate(divide='ignore'):
+        log_v=np.log(v)
+    v_mu,k=np.broadcast_arrays(np.asarray(v_mu,dtype=float),np.asarray(k,dtype=float))
+    shape=v_mu.shape
+    log_c=(np.log(v_mu)-np.log(gamma(1+1/k))).ravel()
+    k=k.ravel()
+    aep=np.empty((log_c.size,len(w)))
+    for s in range(0,log_c.size,chunk_size):
+        e=np.exp(-np.exp(k[s:s+chunk_size,None,None]*(log_v-log_c[s:s+chunk_size,None,None])))
+        np.einsum('ncb,cb->nc',e,w,out=aep[s:s+chunk_size])
+    aep*=8760
+    aep=aep.reshape(shape+(len(w),))
+    if single:
+        aep=aep[...,0]
+    return aep[()]
+
+def aep_height(v_ref,h_ref,h,z_0,power_curve,k=2):
+    # AEP (Wh) at hub height h from the mean wind speed v_ref measured at h_ref (log law)
+    # all arguments broadcast, which covers the (h x z_0) sweeps and rasters of k
+    v_mu=wind_shear_log(v_ref,h_ref,h,z_0)
+    if np.all(np.asarray(k)==2):
+        return np.broadcast_to(aep_batch(v_mu,power_curve),np.broadcast(v_mu,k).shape)[()]
+    return aep_weibull(v_mu,k,power_curve)
+
+class PowerCurveKernel:
+    # compiled Rayleigh AEP of one power curve
+    # the bin weights are computed once and the AEP (Wh) is tabulated on a uniform v_mu grid
+    # refined until the linear interpolation error is guaranteed below tol (Wh)
+    # a query inside [v_min,v_max] costs one table lookup, outside it falls back to aep_batch
+    def __init__(self,power_curve,v_min=1,v_max=15,tol=1.0,cache_dir=None):
+        self.power_curve=power_curve
+        self.cache_dir=cache_dir
+        self.v,self.w=bin_weights(power_curve)
+        self.v_min=v_min
+        self.v_max=v_max
+        self.tol=tol
+        n=64
+        while True:
+            grid=np.linspace(v_min,v_max,n+1)
+            bound=self.error_bound(grid)
+            if bound<=tol:
+                break
+            n*=2
+        self.dv=grid[1]-grid[0]
+        self.table=aep_batch(grid,power_curve)
+        self.max_error=bound
+
+    def error_bound(self,grid):
+        # linear interpolation error <= dv**2/8*max|AEP''| on each interval [u0,u1]
+        # with AEP=8760*sum_j w_j*exp(-a_j/u**2) and |d2/du2 exp(-a/u**2)| <= (4a**2/u0**6+6a/u0**4)*exp(-a/u1**2)
+        a=np.pi/4*self.v**2
+        u0=grid[:-1,None]
+        u1=grid[1:,None]
+        d2=np.sum(np.abs(self.w)*(4*a**2/u0**6+6*a/u0**4)*np.exp(-a/u1**2),axis=1)
+        return np.max((grid[1]-grid[0])**2/8*8760*d2)
+
+    def __call__(self,v_mu):
+        # AEP (Wh) for an array of mean wind speeds of any shape
+        v_mu=np.asarray(v_mu,dtype=float)
+        x=(v_mu-self.v_min)/self.dv
+        i=np.clip(np.floor(x).astype(np.intp),0,len(self.table)-2)
+        t=x-i
+        aep=self.table[i]*(1-t)+self.table[i+1]*t
+        outside=(v_mu<self.v_min)|(v_mu>self.v_max)
+        if np.any(outside):
+            aep[outside]=aep_batch(v_mu[outside],self.power_curve)
+        return aep[()]
+
+    def weibull(self,v_mu,k):
+        # Weibull AEP (Wh) by bilinear lookup in a (v_mu x k) table built at the first call
+        v_mu,k=np.broadcast_arrays(np.asarray(v_mu,dtype=float),np.asarray(k,dtype=float))
+        if not hasattr(self,'weibull_table'):
+            self.build_weibull_table()
+        T=self.weibull_table
+        x=(v_mu-self.v_min)/self.weibull_dv
+        y=(k-self.k_min)/self.weibull_dk
+        i=np.clip(np.floor(x).astype(np.intp),0,T.shape[0]-2)
+        j=np.clip(np.floor(y).astype(np.intp),0,T.shape[1]-2)
+        t=x-i
+        u=y-j
+        aep=(T[i,j]*(1-t)+T[i+1,j]*t)*(1-u)+(T[i,j+1]*(1-t)+T[i+1,j+1]*t)*u
+        outside=(v_mu<self.v_min)|(v_mu>self.v_max)|(k<self.k_min)|(k>self.k_max)
+        if np.any(outside):
+            aep[outside]=aep_weibull(v_mu[outside],k[outside],self.power_curve)
+        return aep[()]
+
+    def build_weibull_table(self,k_min=1.2,k_max=3.2,rtol=1e-3,max_cells=2**18):
+        # each axis is refined until the interpolation error checked at the middle of the cell edges along
+        # that axis is below half the allowed error tol+rtol*AEP, then the cell centres are checked against it
+        # the table stops growing at max_cells entries (weibull_error is then the error reached)
+        # with cache_dir set, the table is saved there and reloaded by the next kernels of the same curve
+        self.k_min=k_min
+        self.k_max=k_max
+        path=None
+        if self.cache_dir is not None:
+            digest=hashlib.sha256(repr((self.v.tolist(),self.w.tolist(),self.v_min,self.v_max,self.tol,
+                                        k_min,k_max,rtol,max_cells)).encode()).hexdigest()[:16]
+            path=os.path.join(self.cache_dir,'weibull-%s.npz'%digest)
+            if os.path.exists(path):
+                with np.load(path) as f:
+                    self.weibull_table=f['table']
+                    self.weibull_dv,self.weibull_dk,self.weibull_error=f['steps']
+                return
+        def excess(exact,interpolated):
+            return np.max(np.abs(exact-interpolated)/(self.tol+rtol*np.abs(exact)))
+        nv,nk=64,8
+        while True:
+            v_mu=np.linspace(self.v_min,self.v_max,nv+1)
+            k=np.linspace(k_min,k_max,nk+1)
+            T=aep_weibull(v_mu[:,None],k[None,:],self.power_curve)
+            vc=(v_mu[:-1]+v_mu[1:])/2
+            kc=(k[:-1]+k[1:])/2
+            centres=aep_weibull(vc[:,None],kc[None,:],self.power_curve)
+            error=np.max(np.abs(centres-(T[:-1,:-1]+T[1:,:-1]+T[:-1,1:]+T[1:,1:])/4))
+            excess_v=excess(aep_weibull(vc[:,None],k[None,:],self.power_curve),(T[:-1,:]+T[1:,:])/2)
+            excess_k=excess(aep_weibull(v_mu[:,None],kc[None,:],self.power_curve),(T[:,:-1]+T[:,1:])/2)
+            if excess_v<=0.5 and excess_k<=0.5:
+                if excess(centres,(T[:-1,:-1]+T[1:,:-1]+T[:-1,1:]+T[1:,1:])/4)<=1:
+                    break
+                excess_v=excess_k=1
+            can_v=excess_v>0.5 and (2*nv+1)*(nk+1)<=max_cells
+            can_k=excess_k>0.5 and (nv+1)*(2*nk+1)<=max_cells
+            if can_v and (excess_v>=excess_k or not can_k):
+                nv*=2
+            elif can_k:
+                nk*=2
+            else:
+                break
+        self.weibull_dv=v_mu[1]-v_mu[0]
+        self.weibull_dk=k[1]-k[0]
+        self.weibull_table=T
+        self.weibull_error=error
+        if path is not None:
+            os.makedirs(self.cache_dir,exist_ok=True)
+            np.savez(path,table=T,steps=np.array([self.weibull_dv,self.weibull_dk,error]))
+
+    def polyfit(self,deg,v_min,v_max):
+        # polynomial fit of the AEP (Wh) on [v_min,v_max] with its maximum absolute error,
+        # for the symbolic cost function which needs a polynomial in V_h (aep_poly)
+        v_mu=np.linspace(v_min,v_max,1001)
+        aep=self(v_mu)
+        poly=np.polyfit(v_mu,aep,deg)
+        return poly,np.max(np.abs(np.polyval(poly,v_mu)-aep))+self.max_error
+
+kernel_cache={}
+
+def power_curve_kernel(power_curve,v_min=1,v_max=15,tol=1.0,cache_dir=None):
+    # cached PowerCurveKernel, one per power curve and table settings (Weibull tables saved in cache_dir)
+    key=(np.asarray(power_curve.Vw,dtype=float).tobytes(),np.asarray(power_curve.Pdc,dtype=float).tobytes(),v_min,v_max,tol)
+    if key not in kernel_cache:
+        kernel_cache[key]=PowerCurveKernel(power_curve,v_min,v_max,tol,cache_dir)
+    return kernel_cache[key]
+
+class PowerCurveRegistry:
+    # library of turbine power curves with a swept-area scaling model
+    # curves are parsed once from the semicolon/decimal-comma csv files (Vw;Pdc) and cached as .npy
+    # files which are memory-mapped on later loads, the csv is parsed again only if it is newer
+    # AEP are in Wh and scale with the swept area: AEP(d,v_mu)=AEP_per_m2(v_mu)*pi*d**2/4
+    def __init__(self,cache_dir='data/power_curve_cache'):
+        self.cache_dir=cache_dir
+        self.sources={}
+        self.curves={}
+        self.diameters={}
+        self.fits={}
+
+    def register(self,name,path,diameter):
+        # power curve csv of a rotor of diameter (mm)
+        self.sources[name]=path
+        self.diameters[name]=diameter
+
+    def register_table(self,name,v_mu,diameters,aep,deg=1):
+        # AEP table (kWh) of several rotor diameters (mm) at the mean wind speeds v_mu, like AEP_df
+        # of the eco-optimization notebook: the AEP per swept area is averaged over the diameters
+        # and fitted once with a polynomial of degree deg
+        aep=np.asarray(aep,dtype=float)*1000 # (v_mu x diameters), Wh
+        area=np.pi*(np.asarray(diameters,dtype=float)*1e-3)**2/4
+        self.fits[name]=np.polyfit(v_mu,np.mean(aep/area,axis=1),deg)
+
+    def get(self,name):
+        # power curve as a DataFrame (Vw, Pdc)
+        if name not in self.curves:
+            path=self.sources[name]
+            digest=hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:12] # one cache per source file
+            cache=os.path.join(self.cache_dir,'%s-%s.npy'%(os.path.splitext(os.path.basename(path))[0],digest))
+            if not os.path.exists(cache) or os.path.getmtime(cache)<os.path.getmtime(path):
+                curve=pd.read_csv(path,delimiter=";",decimal=",")
+                os.makedirs(self.cache_dir,exist_ok=True)
+                np.save(cache,curve[['Vw','Pdc']].to_numpy(dtype=float).T)
+            data=np.load(cache,mmap_mode='r')
+            self.curves[name]=pd.DataFrame({'Vw':data[0],'Pdc':data[1]})
+        return self.curves[name]
+
+    def aep_per_area(self,name,v_mu,k=2):
+        # AEP per swept area (Wh/m2) at the mean wind speeds v_mu (Rayleigh, or Weibull of shape k
+        # for the rotors with a power curve)
+        if name in self.fits:
+            if not np.all(np.asarray(k)==2):
+                raise ValueError('%s is a fitted AEP table (Rayleigh), it has no Weibull AEP for k!=2'%name)
+            return np.polyval(self.fits[name],v_mu)
+        kernel=power_curve_kernel(self.get(name),cache_dir=self.cache_dir)
+        area=np.pi*(self.diameters[name]*1e-3)**2/4
+        if np.all(np.asarray(k)==2):
+            return kernel(v_mu)/area
+        return kernel.weibull(v_mu,k)/area
+
+    def aep(self,name,d,h,v_ref,h_ref,z_0,k=2):
+        # AEP (Wh) of rotors of diameter d (mm) at hub heights h, for a site where the mean wind speed
+        # v_ref is measured at h_ref with the roughness z_0, all arguments broadcast together
+        v_mu=wind_shear(v_ref,h_ref,h,z_0)
+        return self.aep_per_area(name,v_mu,k)*np.pi*(np.asarray(d)*1e-3)**2/4
+
+def read_wind_series(path,column=0,chunk_size=1000000,**read_csv_kwargs):
+    # generator over chunks of a wind speed time series (m/s), the whole series is never loaded
+    # .npy files are memory-mapped, other files are read as csv (column is a name or a position)
+    if str(path).endswith('.npy'):
+        data=np.load(path,mmap_mode='r')
+        if data.ndim>1:
+            data=data[:,column]
+        for s in range(0,len(data),chunk_size):
+            yield np.asarray(data[s:s+chunk_size],dtype=float)
+    else:
+        for chunk in pd.read_csv(path,usecols=[column],chunksize=chunk_size,**read_csv_kwargs):
+            yield chunk.iloc[:,0].to_numpy(dtype=float)
+
+def energy_yield(chunks,power_curve,dt=1/6,h_ref=None,h=None,z_0=None,lifetime=20,bin_width=0.5,v_max=40):
+    # streaming energy yield of a wind speed time series sampled every dt hours (1/6 for 10-minute data)
+    # the power is interpolated on the power curve (0 outside of it) and the speeds are extrapolated
+    # from the anemometer height h_ref to the hub height h with wind_shear_log when h is given
+    # h may be an array of hub heights: AEP, LEP and energy then have its shape and hist gets a last bins axis
+    # missing samples (nan, or negative sentinels such as -9999) are skipped and the AEP is scaled on the valid hours
+    v_pc=np.asarray(power_curve.Vw,dtype=float)
+    p_pc=np.asarray(power_curve.Pdc,dtype=float)
+    shear=np.ones(()) if h is None else np.asarray(wind_shear_log(1,h_ref,h,z_0),dtype=float) # the log law is linear in v_ref
+    shape=shear.shape
+    shear=shear.ravel()
+    n_bins=int(np.ceil(v_max/bin_width))
+    hist=np.zeros(len(shear)*n_bins,dtype=np.int64)
+    energy=np.zeros(len(shear))
+    samples=0
+    missing=0
+    for v in chunks:
+        valid=np.isfinite(v)&(v>=0)
+        if not valid.all():
+            missing+=v.size-np.count_nonzero(valid)
+            v=v[valid]
+        V=v[:,None]*shear # (samples x heights)
+        energy+=np.interp(V,v_pc,p_pc,left=0,right=0).sum(axis=0)*dt
+        bins=np.minimum((V/bin_width).astype(np.intp),n_bins-1)+n_bins*np.arange(len(shear))
+        hist+=np.bincount(bins.ravel(),minlength=len(hist))
+        samples+=v.size
+    aep=energy/(samples*dt)*8760 if samples else np.zeros(len(shear)) # annual energy production (Wh)
+    return {'AEP':aep.reshape(shape)[()],
+            'LEP':(aep*lifetime).reshape(shape)[()], # lifetime energy production (Wh)
+            'energy':energy.reshape(shape)[()],
+            'hist':hist.reshape(shape+(n_bins,)),
+            'bins':bin_width*np.arange(n_bins+1),
+            'samples':samples,
+            'missing':missing}
 
 def wind_shear_log(v_ref,h_ref,h,z_0):
     return v_ref*np.log((h)/z_0)/np.log((h_ref)/z_0)
 
+def wind_shear(v_ref,h_ref,h,z_0=None,alpha=None,d=0,law='log',dtype=np.float64,out=None):
+    # wind speed at height h from the speed v_ref measured at h_ref, all arguments broadcast together
+    # law='log' : v_ref*ln((h-d)/z_0)/ln((h_ref-d)/z_0), d is the displacement height (d=0 is wind_shear_log)
+    # law='power' : v_ref*(h/h_ref)**alpha
+    # the site terms are reduced on their own shape and the result is built in place in out,
+    # so a (heights x raster) call allocates nothing but the output (dtype float32 halves it)
+    if law=='log':
+        shape=np.broadcast_shapes(np.shape(v_ref),np.shape(h_ref),np.shape(h),np.shape(z_0),np.shape(d))
+    elif law=='power':
+        shape=np.broadcast_shapes(np.shape(v_ref),np.shape(h_ref),np.shape(h),np.shape(alpha))
+    else:
+        raise ValueError("law must be 'log' or 'power', not "+repr(law))
+    if out is None:
+        out=np.empty(shape,dtype=dtype)
+    dtype=out.dtype
+    if law=='log':
+        log_z0=np.log(np.asarray(z_0,dtype=dtype))
+        site=np.asarray(v_ref,dtype=dtype)/(np.log(np.asarray(h_ref,dtype=dtype)-np.asarray(d,dtype=dtype))-log_z0)
+        np.subtract(np.asarray(h,dtype=dtype),np.asarray(d,dtype=dtype),out=out)
+        np.log(out,out=out)
+        out-=log_z0
+        out*=site
+    else:
+        np.subtract(np.log(np.asarray(h,dtype=dtype)),np.log(np.asarray(h_ref,dtype=dtype)),out=out)
+        out*=np.asarray(alpha,dtype=dtype)
+        np.exp(out,out=out)
+        out*=np.asarray(v_ref,dtype=dtype)
+    return out[()]
+
 ####COMPUTE RESULTS OF IMPACTS#####
 
 def EF_single_score(scores,NF,WF):
@@ -27,16 +376,1155 @@ def EF_single_score(scores,NF,WF):
     WS=scores/NF*WF
     return np.sum(WS)
 
-def lca_single_score(activities,methods,NF,WF):
-    array_score=np.zeros(len(methods)) #Results are in a np array
-    for i in range(len(activities)): #Cycle through activities
-        for j in range(len(methods)): # Cycle through methods
-            lca = LCA(demand={activities[i]:1},
-                 method=methods[j])
-            lca.lci()
-            lca.lcia()
-            array_score[j]+=lca.score #sum impacts       
-    return EF_single_score(array_score,NF,WF)
+characterization_cache={}
+
+def characterization_matrix(lca,methods):
+    # (methods x biosphere flows) sparse matrix stacking the characterization factors of each method
+    # on the biosphere indices of lca (after lci), cached per method list and biosphere indexing
+    key=(tuple(methods),tuple(lca.biosphere_dict.items()))
+    if key not in characterization_cache:
+        rows=[]
+        for method in methods:
+            lca.switch_method(method)
+            rows.append(lca.characterization_matrix.diagonal())
+        characterization_cache[key]=sparse.csr_matrix(np.vstack(rows))
+    return characterization_cache[key]
+
+def activity_key(activity):
+    # database key of an activity proxy, keys are returned unchanged
+    return getattr(activity,'key',activity)
+
+class LowRankLU:
+    # solver of (A+delta) x = b from the factorization lu of A, for a delta with a few nonzero columns S
+    # (Sherman-Morrison-Woodbury): with x0=A^-1 b and W=A^-1 delta[:,S],
+    # x = x0 - W (I + W[S,:])^-1 x0[S]
+    def __init__(self,lu,cols,delta,W,capacitance):
+        self.lu=lu
+        self.cols=cols
+        self.delta=delta
+        self.W=W
+        self.capacitance=capacitance
+        self.Z=None
+
+    @classmethod
+    def update(cls,lu,delta,max_cond=1e10):
+        # LowRankLU for A+delta (sparse), None if the small system is too ill-conditioned to be trusted
+        cols=np.unique(delta.tocoo().col)
+        delta=delta[:,cols].toarray()
+        W=lu.solve(delta)
+        capacitance=np.eye(len(cols))+W[cols,:]
+        if np.linalg.cond(capacitance)>max_cond:
+            return None
+        return cls(lu,cols,delta,W,capacitance)
+
+    def solve(self,b,trans='N'):
+        x=self.lu.solve(b,trans=trans)
+        if trans=='N':
+            return x-self.W@np.linalg.solve(self.capacitance,x[self.cols])
+        if self.Z is None: # transposed system: x = x0 - A^-T E_S (I + W[S,:])^-T delta[:,S]^T x0
+            E=np.zeros((self.W.shape[0],len(self.cols)))
+            E[self.cols,np.arange(len(self.cols))]=1
+            self.Z=self.lu.solve(E,trans='T')
+        return x-self.Z@np.linalg.solve(self.capacitance.T,self.delta.T@x)
+
+class MatrixLCA:
+    # LCA on the matrices of a set of databases: technosphere A (products x activities),
+    # biosphere B (flows x activities) and the stacked characterization C (methods x flows)
+    # A is factorized once (sparse LU) and every batch of demands is solved with this factorization
+    def __init__(self,technosphere,biosphere,characterization,product_dict,activity_dict,biosphere_dict,methods):
+        self.technosphere=sparse.csc_matrix(technosphere)
+        self.biosphere=sparse.csr_matrix(biosphere)
+        self.characterization=sparse.csr_matrix(characterization)
+        self.product_dict=product_dict
+        self.activity_dict=activity_dict
+        self.biosphere_dict=biosphere_dict
+        self.methods=list(methods)
+        self.lu=None
+        self.version=None
+
+    max_update_rank=32 # changed technosphere columns above which an override is refactorized
+
+    @classmethod
+    def from_brightway(cls,activities,methods):
+        # matrices of all the databases needed by activities, built with a single lci on their union
+        lca=LCA(demand={activity_key(act):1 for act in activities},method=methods[0])
+        lca.lci()
+        engine=cls(lca.technosphere_matrix,lca.biosphere_matrix,characterization_matrix(lca,methods),
+                   lca.product_dict,lca.activity_dict,lca.biosphere_dict,methods)
+        engine.version=database_version(methods) # same cache keys as lca_scores
+        return engine
+
+    def fingerprint(self):
+        # version of the matrices for the ResultCache keys: the database version for engines built from
+        # brightway, otherwise a hash of the matrices, indices and methods
+        if self.version is None:
+            digest=hashlib.sha256(repr((self.methods,sorted(self.product_dict.items()),sorted(self.activity_dict.items()),
+                                        sorted(self.biosphere_dict.items()))).encode())
+            for M in [self.technosphere,self.biosphere,self.characterization]:
+                for a in [M.data,M.indices,M.indptr]:
+                    digest.update(np.ascontiguousarray(a).tobytes())
+            self.version=digest.hexdigest()
+        return self.version
+
+    def reduce(self,demands):
+        # MatrixLCA restricted to the activities reachable from demands through the technosphere
+        # and to the flows they emit: the scores of these demands (and of any demand among the
+        # reachable activities) are unchanged
+        row_col=np.empty(len(self.product_dict),dtype=int)
+        for key,row in self.product_dict.items():
+            row_col[row]=self.activity_dict[key]
+        reached=np.zeros(self.technosphere.shape[1],dtype=bool)
+        front=np.unique(row_col[np.nonzero(self.demand_matrix(demands))[0]])
+        while len(front)>0:
+            reached[front]=True
+            cols=np.unique(row_col[self.technosphere[:,front].indices])
+            front=cols[~reached[cols]]
+        col_key={col:key for key,col in self.activity_dict.items()}
+        keys=[col_key[col] for col in np.where(reached)[0]]
+        cols=[self.activity_dict[key] for key in keys]
+        rows=[self.product_dict[key] for key in keys]
+        biosphere=self.biosphere[:,cols]
+        flows=np.unique(biosphere.tocoo().row)
+        flow_key={row:key for key,row in self.biosphere_dict.items()}
+        reduced=MatrixLCA(self.technosphere[rows,:][:,cols],biosphere[flows,:],self.characterization[:,flows],
+                          {key:i for i,key in enumerate(keys)},{key:i for i,key in enumerate(keys)},
+                          {flow_key[row]:i for i,row in enumerate(flows)},self.methods)
+        reduced.version=self.fingerprint() # same scores, the cached ones stay valid
+        return reduced
+
+    def save(self,path):
+        # matrices, indices and methods in one compressed npz file, loaded back by MatrixLCA.load
+        arrays={'methods':np.array(json.dumps([list(m) for m in self.methods])),'version':np.array(self.fingerprint())}
+        for name,keys in [('product',self.product_dict),('activity',self.activity_dict),('biosphere',self.biosphere_dict)]:
+            ordered=sorted(keys,key=keys.get)
+            arrays[name+'_keys']=np.array(json.dumps([list(k) for k in ordered]))
+        for name in ['technosphere','biosphere','characterization']:
+            M=getattr(self,name)
+            for part in ['data','indices','indptr']:
+                arrays[name+'_'+part]=getattr(M,part)
+            arrays[name+'_shape']=np.array(M.shape)
+        np.savez_compressed(path,**arrays)
+
+    @classmethod
+    def load(cls,path):
+        # MatrixLCA from a file written by save, brightway is not needed
+        with np.load(path) as f:
+            def matrix(name,matrix_type):
+                return matrix_type((f[name+'_data'],f[name+'_indices'],f[name+'_indptr']),shape=tuple(f[name+'_shape']))
+            def keys(name):
+                return {tuple(k):i for i,k in enumerate(json.loads(str(f[name+'_keys'])))}
+            engine=cls(matrix('technosphere',sparse.csc_matrix),matrix('biosphere',sparse.csr_matrix),
+                       matrix('characterization',sparse.csr_matrix),keys('product'),keys('activity'),keys('biosphere'),
+                       [tuple(m) for m in json.loads(str(f['methods']))])
+            if 'version' in f:
+                engine.version=str(f['version'])
+            return engine
+
+    def factorize(self):
+        if self.lu is None:
+            self.lu=splu(self.technosphere)
+        return self.lu
+
+    def demand_matrix(self,demands):
+        # (products x demands) matrix, a demand is an activity (amount 1) or a dict {activity:amount}
+        D=np.zeros((len(self.product_dict),len(demands)))
+        for j,demand in enumerate(demands):
+            if not isinstance(demand,dict):
+                demand={demand:1}
+            for act,amount in demand.items():
+                D[self.product_dict[activity_key(act)],j]+=amount
+        return D
+
+    def supply(self,demands):
+        # (activities x demands) supply arrays, every demand column is solved with the same LU
+        return self.factorize().solve(self.demand_matrix(demands))
+
+    def override(self,overrides):
+        # new MatrixLCA where the amounts of some exchanges are replaced, without any database I/O
+        # overrides maps exchange keys (see exchange_key) to amounts; several
+        # exchanges between the same two activities are summed in the matrices and replaced together
+        # the matrices of self are not modified, the characterization and the indices are shared
+        changes={'technosphere':([],[],[]),'biosphere':([],[],[])}
+        for exchange,amount in overrides.items():
+            matrix,row,col,sign=exchange_position(self,exchange)
+            rows,cols,values=changes[matrix]
+            rows.append(row)
+            cols.append(col)
+            values.append(sign*amount)
+        matrices={'technosphere':self.technosphere,'biosphere':self.biosphere}
+        deltas={}
+        for matrix,(rows,cols,values) in changes.items():
+            if rows:
+                M=matrices[matrix]
+                delta=np.asarray(values)-np.asarray(M[rows,cols]).ravel()
+                deltas[matrix]=sparse.csc_matrix((delta,(rows,cols)),shape=M.shape)
+                matrices[matrix]=M+deltas[matrix]
+        scenario=MatrixLCA(matrices['technosphere'],matrices['biosphere'],self.characterization,
+                           self.product_dict,self.activity_dict,self.biosphere_dict,self.methods)
+        scenario.version=hashlib.sha256(repr((self.fingerprint(),sorted((repr(k),float(v)) for k,v in overrides.items()))).encode()).hexdigest()
+        if 'technosphere' not in deltas:
+            scenario.lu=self.lu # same technosphere, the factorization is shared
+        elif len(set(changes['technosphere'][1]))<=self.max_update_rank:
+            # few changed columns: low-rank update of the factorization of self, refactorized if ill-conditioned
+            scenario.lu=LowRankLU.update(self.factorize(),deltas['technosphere'])
+        return scenario
+
+    def scores(self,demands,overrides=None,chunk_size=256,cache=False):
+        # (demands x methods) array of LCIA scores, for the exchange amounts of overrides if given
+        # cache (opt-in, the in-memory solves being faster than the sqlite round trip): True for the default
+        # on-disk ResultCache or a ResultCache; only the demands without a cached score are solved
+        if cache is not False:
+            return cached_scores(cache,self.fingerprint(),demands,self.methods,overrides,
+                                 lambda todo:self.scores(todo,overrides,chunk_size,cache=False))
+        if overrides:
+            return self.override(overrides).scores(demands,chunk_size=chunk_size,cache=False)
+        scores=np.zeros((len(demands),len(self.methods)))
+        for s in range(0,len(demands),chunk_size):
+            inventory=self.biosphere@self.supply(demands[s:s+chunk_size]) # (flows x demands)
+            scores[s:s+chunk_size,:]=(self.characterization@inventory).T
+        return scores
+
+def export_matrices(activities,methods,path):
+    # writes the matrices reachable from the foreground activities and the characterization of methods
+    # to one compressed file, for brightway-free runs with MatrixLCA.load(path)
+    MatrixLCA.from_brightway(activities,methods).reduce(activities).save(path)
+
+class ActivityIndex:
+    # exact lookups of activities by (database, name, location, unit) and of exchanges by (activity, input),
+    # replacing Database(db).search(name)[0] and the scans of act.exchanges()
+    # the index of a database is built once per version (its 'modified' stamp) and saved as json in cache_dir
+
+    def __init__(self,cache_dir='data/activity_index'):
+        self.cache_dir=cache_dir
+        self.activities={}
+        self.exchanges={}
+        self.versions={}
+
+    def load(self,database):
+        version=databases[database].get('modified')
+        if self.versions.get(database)==version:
+            return
+        digest=hashlib.sha256(repr((projects.current,database,version)).encode()).hexdigest()[:16]
+        path=os.path.join(self.cache_dir,'%s-%s.json'%(database,digest))
+        if os.path.exists(path):
+            with open(path) as f:
+                index=json.load(f)
+        else:
+            index={'activities':[[a.name,a.location,a.data.get('unit'),a.product,a.code]
+                                 for a in ActivityDataset.select().where(ActivityDataset.database==database)],
+                   'exchanges':[[e.output_code,e.input_database,e.input_code,e.id]
+                                for e in ExchangeDataset.select().where(ExchangeDataset.output_database==database)]}
+            os.makedirs(self.cache_dir,exist_ok=True)
+            with open(path,'w') as f:
+                json.dump(index,f)
+        activities={}
+        for name,location,unit,product,code in index['activities']:
+            activities.setdefault(name,[]).append((location,unit,product,(database,code)))
+        exchanges={}
+        for output_code,input_database,input_code,id in index['exchanges']:
+            exchanges.setdefault(((database,output_code),(input_database,input_code)),[]).append(id)
+        self.activities[database]=activities
+        self.exchanges[database]=exchanges
+        self.versions[database]=version
+
+    def key(self,database,name,location=None,unit=None,product=None):
+        # key of the only activity of database named name (and matching location, unit and product if given)
+        self.load(database)
+        matches=[key for loc,u,prod,key in self.activities[database].get(name,[])
+                 if (location is None or loc==location) and (unit is None or u==unit) and (product is None or prod==product)]
+        if not matches:
+            raise KeyError('no activity %r (location %s, unit %s) in %s'%(name,location,unit,database))
+        if len(matches)>1:
+            raise ValueError('%d activities %r in %s, give location, unit or product'%(len(matches),name,database))
+        return matches[0]
+
+    def activity(self,database,name,location=None,unit=None,product=None):
+        return get_activity(self.key(database,name,location,unit,product))
+
+    def exchange(self,activity,input):
+        # the exchange of activity from input (activities or keys)
+        output_key=activity_key(activity)
+        self.load(output_key[0])
+        ids=self.exchanges[output_key[0]].get((output_key,activity_key(input)),[])
+        if not ids:
+            raise KeyError('no exchange from %s in %s'%(activity_key(input),output_key))
+        if len(ids)>1:
+            raise ValueError('%d exchanges from %s in %s'%(len(ids),activity_key(input),output_key))
+        return Exchange(ExchangeDataset.get_by_id(ids[0]))
+
+activity_index=ActivityIndex()
+
+def exchange_key(exchange):
+    # (input key, output key) of an exchange object, used as key of the overrides dictionaries
+    return (exchange['input'],exchange['output'])
+
+def exchange_position(engine,exchange):
+    # matrix ('technosphere' or 'biosphere'), row, column and sign of an exchange in engine (MatrixLCA)
+    # exchange is an exchange object or an (input key, output key) tuple; technosphere inputs are
+    # stored with a negative sign, production exchanges (input==output) and biosphere flows as is
+    if isinstance(exchange,tuple):
+        input_key,output_key=exchange
+    else:
+        input_key,output_key=exchange['input'],exchange['output']
+    input_key=activity_key(input_key)
+    output_key=activity_key(output_key)
+    col=engine.activity_dict[output_key]
+    if input_key in engine.biosphere_dict:
+        return 'biosphere',engine.biosphere_dict[input_key],col,1
+    return 'technosphere',engine.product_dict[input_key],col,1 if input_key==output_key else -1
+
+class LinearExchangeModel:
+    # exact affine model of a weighted score w.r.t. the amounts of a set of exchanges:
+    # score(amounts)=base_score+gradient@(amounts-base_amounts), amounts is (..., exchanges)
+    def __init__(self,base_amounts,base_score,gradient):
+        self.base_amounts=base_amounts
+        self.base_score=base_score
+        self.gradient=gradient
+
+    def __call__(self,amounts):
+        return self.base_score+(np.asarray(amounts,dtype=float)-self.base_amounts)@self.gradient
+
+def linear_exchange_model(engine,demands,exchanges,weights):
+    # sensitivity of the score sum_m weights[m]*score_m of the summed demands to each exchange amount
+    # (weights=WF/NF gives the EF single score), from one direct and one adjoint solve:
+    # d score/d A_ij=-lambda_i*x_j with x=A^-1 f and lambda=A^-T B^T c
+    # the model is exact when no changed column is upstream of a changed technosphere input,
+    # i.e. (A^-1)[columns,inputs]==0, otherwise the score is not linear in the amounts
+    lu=engine.factorize()
+    f=engine.demand_matrix(demands).sum(axis=1)
+    x=lu.solve(f)
+    c=engine.characterization.T@np.asarray(weights,dtype=float) # weighted factors per flow
+    lam=lu.solve(engine.biosphere.T@c,trans='T')
+    positions=[exchange_position(engine,exc) for exc in exchanges]
+    A=engine.technosphere
+    B=engine.biosphere
+    base_amounts=np.zeros(len(positions))
+    gradient=np.zeros(len(positions))
+    for k,(matrix,row,col,sign) in enumerate(positions):
+        if matrix=='technosphere':
+            base_amounts[k]=sign*A[row,col]
+            gradient[k]=-sign*lam[row]*x[col]
+        else:
+            base_amounts[k]=B[row,col]
+            gradient[k]=c[row]*x[col]
+    rows=sorted({row for matrix,row,col,sign in positions if matrix=='technosphere'})
+    cols=sorted({col for matrix,row,col,sign in positions})
+    if rows:
+        E=np.zeros((A.shape[0],len(rows)))
+        E[rows,np.arange(len(rows))]=1
+        if np.abs(lu.solve(E)[cols,:]).max()>1e-12: # production exchanges always fall here
+            raise ValueError("the score is not linear in these exchange amounts (loop through a changed activity)")
+    return LinearExchangeModel(base_amounts,c@(B@x),gradient)
+
+def tower_exchange_amounts(height,tower_steel_tube_mass,m_wire_fit,area_coat_fit):
+    # (heights x 11) amounts of the mast exchanges of the "LOOP WITH INCREMENTATION OF MAST LENGTH" cell,
+    # in the order pipe, steel_ua, wire_steel, zinc, copper, wire, polyethylene, extrusion, lorry, train, container
+    height=np.asarray(height,dtype=float)
+    m_tube=0.48*8.75483+tower_steel_tube_mass(height)
+    m_wire=np.polyval(m_wire_fit,height)
+    return np.stack([m_tube,
+                     m_tube+m_wire,
+                     m_wire,
+                     np.polyval(area_coat_fit,height),
+                     height*8960*3*0.000004,
+                     height*8960*3*0.000004,
+                     0.011848*height,
+                     0.011848*height,
+                     25/12*height, # scaling of transport
+                     25.3/12*height,
+                     56/12*height],axis=-1)
+
+def share_matrices(engine):
+    # copies the sparse arrays of the matrices of engine into shared memory blocks
+    # returns the blocks (to close and unlink after use) and a picklable description to attach them
+    blocks=[]
+    description={'dicts':(engine.product_dict,engine.activity_dict,engine.biosphere_dict),'methods':engine.methods,
+                 'version':engine.fingerprint()}
+    for name,M in [('technosphere',engine.technosphere),('biosphere',engine.biosphere),('characterization',engine.characterization)]:
+        arrays={}
+        for part in ['data','indices','indptr']:
+            a=getattr(M,part)
+            block=shared_memory.SharedMemory(create=True,size=max(a.nbytes,1))
+            np.ndarray(a.shape,dtype=a.dtype,buffer=block.buf)[:]=a
+            blocks.append(block)
+            arrays[part]=(block.name,a.shape,a.dtype.str)
+        description[name]=(M.format,M.shape,arrays)
+    return blocks,description
+
+def attach_matrices(description):
+    # read-only MatrixLCA on the shared memory blocks of share_matrices, and the attached blocks
+    blocks=[]
+    matrices={}
+    for name in ['technosphere','biosphere','characterization']:
+        fmt,shape,arrays=description[name]
+        parts=[]
+        for part in ['data','indices','indptr']:
+            block_name,part_shape,dtype=arrays[part]
+            block=shared_memory.SharedMemory(name=block_name)
+            blocks.append(block)
+            a=np.ndarray(part_shape,dtype=dtype,buffer=block.buf)
+            a.flags.writeable=False
+            parts.append(a)
+        matrix_type=sparse.csc_matrix if fmt=='csc' else sparse.csr_matrix
+        matrices[name]=matrix_type(tuple(parts),shape=shape,copy=False)
+    product_dict,activity_dict,biosphere_dict=description['dicts']
+    engine=MatrixLCA(matrices['technosphere'],matrices['biosphere'],matrices['characterization'],
+                     product_dict,activity_dict,biosphere_dict,description['methods'])
+    engine.version=description['version']
+    return engine,blocks
+
+worker_engine=None
+worker_blocks=None
+
+def sweep_worker_init(description):
+    global worker_engine, worker_blocks
+    worker_engine,worker_blocks=attach_matrices(description)
+
+def sweep_worker(demands,overrides_chunk,summed=True):
+    # scores of demands for each overrides of the chunk, in a pool worker: (points x methods) summed
+    # over the demands, or (points x demands x methods)
+    scores=np.array([worker_engine.scores(demands,overrides) for overrides in overrides_chunk])
+    return scores.sum(axis=1) if summed else scores
+
+def parallel_sweep(engine,demands,overrides_list,NF=None,WF=None,processes=None,chunks_per_process=4,cache=False):
+    # scores of the same demands for many scenario points (one overrides dict per point), fanned out
+    # to a process pool; the matrices are exported once into shared memory and every worker solves
+    # its chunk of points on read-only snapshots of them
+    # returns a (points x methods) DataFrame, with a single_score column when NF and WF are given
+    # cache (opt-in, True or a ResultCache): the points already swept are read back in the parent process, the
+    # workers only solve the missing ones and the parent stores their scores in one transaction
+    n_met=len(engine.methods)
+    if cache is False:
+        todo=list(range(len(overrides_list)))
+    else:
+        if cache is True:
+            cache=result_cache()
+        version=engine.fingerprint()
+        keys=[cache.key(version,d,m,o) for o in overrides_list for d in demands for m in engine.methods]
+        found=np.array([np.nan if s is None else s for s in cache.get(keys)]).reshape(len(overrides_list),len(demands),n_met)
+        todo=list(np.where(np.isnan(found).any(axis=(1,2)))[0])
+    results=[]
+    if todo:
+        processes=processes or os.cpu_count()
+        n_chunks=max(1,min(len(todo),processes*chunks_per_process))
+        bounds=np.linspace(0,len(todo),n_chunks+1).astype(int)
+        chunks=[[overrides_list[i] for i in todo[bounds[c]:bounds[c+1]]] for c in range(n_chunks)]
+        blocks,description=share_matrices(engine)
+        try:
+            with ProcessPoolExecutor(processes,initializer=sweep_worker_init,initargs=(description,)) as pool:
+                results=list(pool.map(sweep_worker,[demands]*n_chunks,chunks,[cache is False]*n_chunks))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    if cache is False:
+        scores=np.vstack(results)
+    else:
+        if todo:
+            found[todo]=np.concatenate(results)
+            cache.put([keys[(i*len(demands)+j)*n_met+k] for i in todo for j in range(len(demands)) for k in range(n_met)],
+                      found[todo].ravel())
+            cache.evict()
+        scores=found.sum(axis=1)
+    scores=pd.DataFrame(scores,columns=range(n_met))
+    if NF is not None:
+        scores['single_score']=np.sum(scores.iloc[:,:len(engine.methods)].to_numpy()/NF*WF,axis=1)
+    return scores
+
+def database_version(lcia_methods):
+    # fingerprint of the current project, of the modification times of its databases and of the
+    # metadata of the methods: changes whenever a database or a method is rewritten
+    state=[projects.current,sorted((name,meta.get('modified'),meta.get('processed')) for name,meta in databases.items()),
+           [(m,sorted(methods[m].items())) for m in lcia_methods]]
+    return hashlib.sha256(repr(state).encode()).hexdigest()
+
+class ResultCache:
+    # on-disk content-addressed store of LCIA scores (sqlite), one row per (activity, method) score
+    # keys hash the database version, the demand activity, the method and the overridden exchange amounts
+    # entries older than max_age (s) are dropped, then the oldest ones beyond max_entries
+
+    def __init__(self,path='data/lca_cache.sqlite',max_entries=1000000,max_age=90*24*3600):
+        self.path=path
+        self.max_entries=max_entries
+        self.max_age=max_age
+        os.makedirs(os.path.dirname(path) or '.',exist_ok=True)
+        with sqlite3.connect(path) as db:
+            db.execute('CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score REAL, created REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS scores_created ON scores (created)')
+
+    def key(self,version,demand,method,overrides=None):
+        # demand: an activity, or a dict {activity:amount} (see MatrixLCA.demand_matrix)
+        if isinstance(demand,dict):
+            demand=sorted((repr(activity_key(a)),float(x)) for a,x in demand.items())
+        else:
+            demand=activity_key(demand)
+        overrides=sorted((repr(k),float(v)) for k,v in (overrides or {}).items())
+        return hashlib.sha256(repr((version,demand,tuple(method),overrides)).encode()).hexdigest()
+
+    def get(self,keys):
+        # cached scores of keys (None where missing)
+        found={}
+        with sqlite3.connect(self.path) as db:
+            for i in range(0,len(keys),500):
+                chunk=keys[i:i+500]
+                query='SELECT key, score FROM scores WHERE key IN (%s) AND created > ?'%','.join('?'*len(chunk))
+                found.update(db.execute(query,chunk+[time.time()-self.max_age]).fetchall())
+        return [found.get(key) for key in keys]
+
+    def put(self,keys,scores):
+        # one transaction per batch of scores; evict() is left to the end of the batch
+        now=time.time()
+        with sqlite3.connect(self.path,timeout=60) as db:
+            db.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?)',[(k,float(s),now) for k,s in zip(keys,scores)])
+
+    def evict(self):
+        with sqlite3.connect(self.path,timeout=60) as db:
+            db.execute('DELETE FROM scores WHERE created < ?',(time.time()-self.max_age,))
+            n=db.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+            if n>self.max_entries:
+                db.execute('DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY created LIMIT ?)',(n-self.max_entries,))
+
+    def clear(self):
+        with sqlite3.connect(self.path) as db:
+            db.execute('DELETE FROM scores')
+
+result_caches={}
+
+def result_cache(path='data/lca_cache.sqlite'):
+    if path not in result_caches:
+        result_caches[path]=ResultCache(path)
+    return result_caches[path]
+
+def cached_scores(cache,version,demands,methods,overrides,compute):
+    # (demands x methods) scores read from cache (True for the default ResultCache), compute(demands)
+    # calculating the scores of the demands with a missing one, which are then stored
+    if cache is True:
+        cache=result_cache()
+    keys=[cache.key(version,d,m,overrides) for d in demands for m in methods]
+    scores=np.array([np.nan if s is None else s for s in cache.get(keys)]).reshape(len(demands),len(methods))
+    missing=np.where(np.isnan(scores).any(axis=1))[0]
+    if len(missing)>0:
+        scores[missing]=compute([demands[i] for i in missing])
+        cache.put([keys[i*len(methods)+j] for i in missing for j in range(len(methods))],scores[missing].ravel())
+        cache.evict()
+    return scores
+
+def lca_scores(activities,methods,overrides=None,cache=True):
+    # (activities x methods) array of LCIA scores, one factorization for all the activities
+    # overrides replaces exchange amounts for this calculation only (see MatrixLCA.override)
+    # cache: True for the default on-disk ResultCache, a ResultCache, or False to always recompute;
+    # only the activities with a missing score are calculated, and nothing is built when all are cached
+    if cache is False:
+        return MatrixLCA.from_brightway(activities,methods).scores(activities,overrides,cache=False)
+    return cached_scores(cache,database_version(methods),activities,methods,overrides,
+                         lambda todo:MatrixLCA.from_brightway(todo,methods).scores(todo,overrides,cache=False))
+
+def lca_tables(engine,order,activities,NF,WF,overrides=None,cache=False):
+    # store_score_* (activities x methods) and contributions_*_df (EF single score per activity)
+    # tables of the notebook, from one batched solve of engine (MatrixLCA, see scores for overrides and cache)
+    scores=engine.scores(activities,overrides,cache=cache)
+    store_score=pd.DataFrame(scores,index=list(order.keys()))
+    contributions=pd.DataFrame(np.sum(scores/NF*WF,axis=1),index=list(order.keys()))
+    return store_score,contributions
+
+def methods_choice(scores,methods,NF,WF):
+    # ranking of the impact categories by share of the EF single score, as in the notebook
+    # scores: total raw score per method; returns score_sort_df (Category_number, Raw score,
+    # Normalized_Weighted, Score_ratio, Cumulative), the descending order I and methods_80
+    weighted=scores/NF*WF
+    I=np.argsort(-weighted/np.sum(weighted))
+    ratio=weighted[I]/np.sum(weighted)
+    cumulative=np.cumsum(ratio)
+    score_sort_df=pd.DataFrame({'Category_number':[methods[i][1] for i in I],'Raw score':scores[I],
+                                'Normalized_Weighted':weighted[I],'Score_ratio':ratio,'Cumulative':cumulative})
+    methods_80=[methods[i][1] for i in I[:np.sum(cumulative<0.8)]]
+    return score_sort_df,I,methods_80
+
+def activity_groups(**orders):
+    # activity group of every label of the orders, e.g. activity_groups(wind_turbine=order_wt,mast=order_18m)
+    return {label:group for group,order in orders.items() for label in order}
+
+class ResultsStore:
+    # columnar (parquet) store of LCIA scores in long format, one row per
+    # (scenario, group, activity, method, height, grid) with the score, replacing the score_*/contributions_* csv
+    # reads push the filters down to the parquet row groups, e.g. store.read(scenario='18',method=['climate change'])
+    keys=['scenario','group','activity','method','height','grid']
+    categories=['scenario','group','activity','method']
+
+    def __init__(self,path='lca_12_18/results.parquet'):
+        self.path=path
+
+    @staticmethod
+    def records(store_score,methods,scenario,groups=None,height=np.nan,grid=False):
+        # long-format rows of a store_score table (activities x methods)
+        n_act,n_met=store_score.shape
+        labels=list(store_score.index)
+        return pd.DataFrame({'scenario':scenario,
+                             'group':np.repeat([(groups or {}).get(a,'') for a in labels],n_met),
+                             'activity':np.repeat(labels,n_met),
+                             'method':np.tile([methods[int(j)][1] for j in store_score.columns],n_act),
+                             'method_index':np.tile(np.asarray(store_score.columns,dtype=np.int16),n_act),
+                             'height':np.float64(height),'grid':bool(grid),
+                             'score':store_score.to_numpy(dtype=np.float64).ravel()})
+
+    def write(self,df):
+        # replaces the rows of df's keys, sorted so that the row group statistics select scenarios and methods
+        if os.path.exists(self.path):
+            df=pd.concat([pd.read_parquet(self.path).astype({c:str for c in self.categories}),
+                          df.astype({c:str for c in self.categories})],ignore_index=True)
+            df=df.drop_duplicates(self.keys,keep='last')
+        df=df.sort_values(['scenario','method_index','group','activity']).astype({c:'category' for c in self.categories})
+        os.makedirs(os.path.dirname(self.path) or '.',exist_ok=True)
+        df.to_parquet(self.path,index=False,row_group_size=65536)
+
+    def read(self,columns=None,**filters):
+        # rows matching all filters (a value or a list of values per column)
+        filters=[(c,'in',list(v)) if isinstance(v,(list,tuple,set)) else (c,'==',v) for c,v in filters.items()]
+        return pd.read_parquet(self.path,columns=columns,filters=filters or None)
+
+    def table(self,**filters):
+        # store_score-like table (activities x method_index) of the selected rows
+        df=self.read(columns=['activity','method_index','score'],**filters)
+        return df.pivot_table(index='activity',columns='method_index',values='score',aggfunc='sum',sort=False,observed=True)
+
+scenario_csv_options={'contributions':{'decimal':','},'methods_choice':{'decimal':','}}
+
+def scenario_overrides(scenario,exchanges=None):
+    # exchange amounts of a run_scenarios scenario: its 'height' (m) scales the mast exchanges with
+    # tower_exchange_amounts, 'battery' (kg) and 'grid_kwh' set the battery and grid electricity exchanges,
+    # then its explicit 'overrides' apply
+    # exchanges: {'mast':(keys,tower_steel_tube_mass,m_wire_fit,area_coat_fit),'battery':key,'grid':key} with the
+    # exchange keys (input,output) in the order of tower_exchange_amounts for the mast
+    exchanges=exchanges or {}
+    overrides={}
+    for entry,name in [('height','mast'),('battery','battery'),('grid_kwh','grid')]:
+        if entry in scenario and name not in exchanges:
+            raise ValueError("scenario entry '%s' needs the '%s' exchange key" % (entry,name))
+    if 'height' in scenario:
+        keys,*fits=exchanges['mast']
+        overrides.update(zip(keys,tower_exchange_amounts(scenario['height'],*fits).tolist()))
+    for entry,name in [('battery','battery'),('grid_kwh','grid')]:
+        if entry in scenario:
+            overrides[exchanges[name]]=float(scenario[entry])
+    overrides.update(scenario.get('overrides') or {})
+    return overrides
+
+def run_scenarios(scenarios,methods,NF,WF,categories_shortlist=5,engine=None,store=None,cache=False,exchanges=None):
+    # runs the LCA tables of several system scenarios on one shared factorization
+    # scenarios maps a name to a dict with
+    #   'order': activity labels (e.g. order_wt | order_18m | order_electronics)
+    #   'activities': the activities in the same order
+    #   'height', 'battery', 'grid_kwh': mast height (m), battery weight (kg) and grid electricity (kWh), turned into
+    #   overrides of the exchanges keys (see scenario_overrides), e.g. {'height':18,'battery':bat_weight_kg[1]}
+    #   'overrides': other exchange amounts of the scenario, e.g. {(batteries_key,act_batteries.key):bat_weight_kg[1]}
+    #   'outputs': csv path of some of the tables, e.g. {'full_impacts':'lca_12_18/score_18_full_impacts.csv'}
+    # tables: full_impacts (store_score), contributions, methods_choice (score_sort_df) and shortlist
+    # (store_score of the categories_shortlist first categories); returns {name: {table: DataFrame}}
+    # cache: opt-in ResultCache of the scores (see MatrixLCA.scores), shared with lca_scores
+    # with a ResultsStore, the full impacts of every scenario are also written to it, with the optional
+    # 'groups' (see activity_groups), 'height' and 'grid' (default: 'grid_kwh' given) entries of the scenario as dimensions
+    if engine is None:
+        activities=list({activity_key(a):a for s in scenarios.values() for a in s['activities']}.values())
+        engine=MatrixLCA.from_brightway(activities,methods)
+    results={}
+    for name,scenario in scenarios.items():
+        store_score,contributions=lca_tables(engine,scenario['order'],scenario['activities'],NF,WF,
+                                             scenario_overrides(scenario,exchanges),cache)
+        score_sort_df,I,methods_80=methods_choice(store_score.sum(axis=0).to_numpy(),methods,NF,WF)
+        tables={'full_impacts':store_score,'contributions':contributions,'methods_choice':score_sort_df,
+                'shortlist':store_score[I[0:categories_shortlist]]}
+        for table,path in scenario.get('outputs',{}).items():
+            tables[table].to_csv(path,**scenario_csv_options.get(table,{}))
+        results[name]=tables
+    if store is not None:
+        store.write(pd.concat([ResultsStore.records(results[name]['full_impacts'],methods,name,s.get('groups'),
+                                                    s.get('height',np.nan),s.get('grid','grid_kwh' in s))
+                               for name,s in scenarios.items()],ignore_index=True))
+    return results
+
+def lca_single_score(activities,methods,NF,WF,overrides=None,cache=True):
+    return EF_single_score(lca_scores(activities,methods,overrides,cache).sum(axis=0),NF,WF) #sum impacts
+
+####HEIGHT OPTIMIZATION####
+
+def h_opt_map(f_ce,variables,v_array,z0_array,h_array,h_r=10,E_ne=None,chunk_size=2**24):
+    # optimal tower height of h_array for every (V_r, z_0) site, f_ce being compiled once
+    # variables: the sympy symbols (h, V_r, z_0, h_r) of f_ce (and E_ne)
+    # the (V_r x z_0 x h) cost tensor is evaluated and argmin-reduced by blocks of V_r of about chunk_size cells
+    # returns h_opt_df in the layout of h_opt_map.csv (columns "z=<z_0>" and Vr), and the daily energy
+    # at the optimal heights (den_opt_df, same layout) if E_ne is given
+    import sympy as sp
+    v_array=np.asarray(v_array,dtype=float)
+    z0_array=np.asarray(z0_array,dtype=float)
+    h_array=np.asarray(h_array,dtype=float)
+    f=sp.lambdify(variables,f_ce,'numpy')
+    i_opt=np.zeros((len(v_array),len(z0_array)),dtype=int)
+    step=max(1,chunk_size//(len(z0_array)*len(h_array)))
+    for s in range(0,len(v_array),step):
+        cost=f(h_array[None,None,:],v_array[s:s+step,None,None],z0_array[None,:,None],h_r)
+        i_opt[s:s+step]=np.argmin(np.broadcast_to(cost,(len(v_array[s:s+step]),len(z0_array),len(h_array))),axis=2)
+    columns=["z=" + str(z) for z in z0_array]
+    h_opt_df=pd.DataFrame(h_array[i_opt],columns=columns)
+    h_opt_df.loc[:,"Vr"]=v_array
+    if E_ne is None:
+        return h_opt_df
+    e=sp.lambdify(variables,E_ne,'numpy')
+    den_opt_df=pd.DataFrame(np.broadcast_to(e(h_array[i_opt],v_array[:,None],z0_array[None,:],h_r),i_opt.shape),columns=columns)
+    den_opt_df.loc[:,"Vr"]=v_array
+    return h_opt_df,den_opt_df
+
+def bracketed_minimize(df,d2f,lo,hi,tol=1e-3,max_iter=50):
+    # vectorized minimization over [lo,hi] (arrays) from the derivative df(x) and second derivative d2f(x):
+    # bounds where df does not change sign, otherwise safeguarded Newton on df=0 (bisection whenever the
+    # Newton step leaves the bracket), the bracket always keeping df(lo)<0<df(hi), until it is narrower than tol
+    lo,hi=np.broadcast_arrays(np.asarray(lo,dtype=float),np.asarray(hi,dtype=float))
+    lo,hi=lo.copy(),hi.copy()
+    g_lo,g_hi=np.broadcast_to(df(lo),lo.shape),np.broadcast_to(df(hi),hi.shape)
+    x=np.where(g_lo>=0,lo,np.where(g_hi<=0,hi,(lo+hi)/2))
+    active=(g_lo<0)&(g_hi>0)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        g=np.broadcast_to(df(x),x.shape)
+        lo=np.where(active&(g<0),x,lo)
+        hi=np.where(active&(g>=0),x,hi)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            newton=x-g/np.broadcast_to(d2f(x),x.shape)
+        inside=(newton>lo)&(newton<hi)
+        step=np.where(inside,newton,(lo+hi)/2)
+        converged=(hi-lo<tol)|(np.abs(step-x)<tol/2)
+        x=np.where(active,step,x)
+        active&=~converged
+    return x
+
+cost_derivatives={}
+
+def h_opt_solve(f_ce,variables,V_r,z_0,h_r=10,h_min=12,h_max=30,tol=1e-3):
+    # optimal tower height in [h_min,h_max] of every (V_r, z_0) site (broadcast arrays), to tol (m),
+    # from the analytic first and second derivatives of f_ce in h (see bracketed_minimize)
+    # variables: the sympy symbols (h, V_r, z_0, h_r) of f_ce; the derivatives are compiled once per f_ce
+    key=(f_ce,tuple(variables))
+    if key not in cost_derivatives:
+        import sympy as sp
+        h=variables[0]
+        cost_derivatives[key]=(sp.lambdify(variables,sp.diff(f_ce,h),'numpy'),sp.lambdify(variables,sp.diff(f_ce,h,2),'numpy'))
+    df,d2f=cost_derivatives[key]
+    V_r,z_0=np.broadcast_arrays(np.asarray(V_r,dtype=float),np.asarray(z_0,dtype=float))
+    lo=np.full(V_r.shape,float(h_min))
+    return bracketed_minimize(lambda x:df(x,V_r,z_0,h_r),lambda x:d2f(x,V_r,z_0,h_r),lo,float(h_max),tol)
+
+class HOptSurface:
+    # piecewise bilinear lookup surface of the optimal height over (V_r, log z_0): columns of constant z_0, each
+    # with its own V_r grid, interpolated linearly in V_r then in log z_0 between the two nearest columns
+    # build() refines every column in V_r on its own, so the kinks where h_opt reaches h_min/h_max only add
+    # points to the columns that cross them, and a pinned range (h_opt constant) is never refined; columns are
+    # inserted where the solver between two columns deviates from their interpolation; max_error is the largest
+    # deviation found at these checks (above tol when a cap was reached)
+    # queries outside the grid are clamped to its edges, z_0<=0 (water, no data) gives h_no_roughness
+    def __init__(self,v,z,h,max_error=np.nan,h_no_roughness=12,indptr=None):
+        # v, h: the V_r grid shared by every column and the (v x z) table of heights, or with indptr the
+        # concatenated V_r grids and heights of the columns, column j being indptr[j]:indptr[j+1]
+        v=np.asarray(v,dtype=float)
+        h=np.asarray(h,dtype=np.float32)
+        if indptr is None:
+            indptr=np.arange(h.shape[1]+1)*len(v)
+            v=np.tile(v,h.shape[1])
+            h=h.T.ravel()
+        self.v=v
+        self.z=np.asarray(z,dtype=float)
+        self.h=h
+        self.indptr=np.asarray(indptr,dtype=np.int64)
+        self.max_error=max_error
+        self.h_no_roughness=h_no_roughness
+        # one sorted search key for all the columns: V_r shifted by the column index times a span above the range
+        self.span=v.max()-v.min()+1
+        self.keys=v+np.repeat(np.arange(len(self.z)),np.diff(self.indptr))*self.span
+
+    @classmethod
+    def build(cls,solve,z0_values,v_min=2.5,v_max=8,tol=0.01,n_v=17,h_min=12,h_max=30,max_iter=12,max_points=2048,
+              max_columns=1024):
+        # solve(V_r,z_0): optimal heights of broadcast arrays of sites in [h_min,h_max], e.g.
+        # lambda V,Z: h_opt_solve(f_ce,(h,V_r,z_0,h_r),V,Z)
+        # a column gets the midpoints of the intervals whose interpolation is more than tol/2 off the solver, or
+        # with one end pinned at h_min/h_max (a kink, which the midpoint may miss), up to max_points; columns are
+        # inserted at the middle log z_0 of the worst pair first, up to max_columns; intervals and pairs are
+        # halved at most max_iter times
+        import heapq
+        dv=(v_max-v_min)/(n_v-1)/2**max_iter
+
+        def column(logz):
+            v=np.linspace(v_min,v_max,n_v)
+            h=solve(v,np.exp(logz))
+            while True:
+                v_mid=(v[:-1]+v[1:])/2
+                h_mid=solve(v_mid,np.exp(logz))
+                err=np.abs(h_mid-(h[:-1]+h[1:])/2)
+                pinned=(h<=h_min+1e-6)|(h>=h_max-1e-6)
+                refine=np.where(((err>tol/2)|(pinned[:-1]!=pinned[1:]))&(np.diff(v)>1.5*dv))[0]
+                if len(refine)==0 or len(v)>=max_points:
+                    return v,h,err.max()
+                refine=np.sort(refine[np.argsort(err[refine])[::-1][:max_points-len(v)]])
+                v=np.insert(v,refine+1,v_mid[refine])
+                h=np.insert(h,refine+1,h_mid[refine])
+
+        def pair_error(a,b):
+            # deviation of the solver at the middle log z_0 from its mean at a and b, on the V_r points of both
+            # columns and their midpoints: tol/2 for the interpolation in log z_0, tol/2 for the one in V_r
+            v=np.union1d(columns[a][0],columns[b][0])
+            v=np.concatenate([v,(v[:-1]+v[1:])/2])
+            h=solve(v[None,:],np.exp([[a],[(a+b)/2],[b]]))
+            return np.abs(h[1]-(h[0]+h[2])/2).max()
+
+        logz=np.log(np.unique(np.asarray(z0_values,dtype=float)))
+        columns={lz:column(lz) for lz in logz}
+        pairs=[(-pair_error(a,b),0,a,b) for a,b in zip(logz[:-1],logz[1:])]
+        heapq.heapify(pairs)
+        errors=[c[2] for c in columns.values()]
+        while pairs and -pairs[0][0]>tol/2 and len(columns)<max_columns:
+            err,depth,a,b=heapq.heappop(pairs)
+            if depth==max_iter:
+                errors.append(-err)
+                continue
+            mid=(a+b)/2
+            columns[mid]=column(mid)
+            errors.append(columns[mid][2])
+            heapq.heappush(pairs,(-pair_error(a,mid),depth+1,a,mid))
+            heapq.heappush(pairs,(-pair_error(mid,b),depth+1,mid,b))
+        max_error=max(errors+[-p[0] for p in pairs])
+        logz=sorted(columns)
+        return cls(np.concatenate([columns[lz][0] for lz in logz]),np.exp(logz),
+                   np.concatenate([columns[lz][1] for lz in logz]),max_error,
+                   indptr=np.cumsum([0]+[len(columns[lz][0]) for lz in logz]))
+
+    @classmethod
+    def from_table(cls,h_opt_df):
+        # surface on the grid of an h_opt_map.csv table (columns "z=<z_0>" and Vr)
+        columns=[c for c in h_opt_df.columns if str(c).startswith('z=')]
+        z=np.array([float(c[2:]) for c in columns])
+        order=np.argsort(z)
+        return cls(h_opt_df['Vr'].to_numpy(),z[order],h_opt_df[columns].to_numpy()[:,order])
+
+    def column(self,j,V_r):
+        # heights of the columns j (array) at V_r, clamped to the V_r range of each column
+        start,stop=self.indptr[j],self.indptr[j+1]
+        V_r=np.clip(V_r,self.v[start],self.v[stop-1])
+        i=np.clip(np.searchsorted(self.keys,V_r+j*self.span,side='right')-1,start,stop-2)
+        t=(V_r-self.v[i])/(self.v[i+1]-self.v[i])
+        return (1-t)*self.h[i]+t*self.h[i+1]
+
+    def __call__(self,V_r,z_0):
+        V_r,z_0=np.broadcast_arrays(np.asarray(V_r,dtype=float),np.asarray(z_0,dtype=float))
+        logz=np.log(self.z)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            lz=np.log(z_0)
+        if len(logz)>1:
+            j=np.clip(np.searchsorted(logz,lz,side='right')-1,0,len(logz)-2)
+            u=np.clip(np.nan_to_num((lz-logz[j])/(logz[j+1]-logz[j])),0,1)
+            h=(1-u)*self.column(j,V_r)+u*self.column(j+1,V_r)
+        else:
+            h=self.column(np.zeros(V_r.shape,dtype=int),V_r)
+        return np.where(z_0>0,h,self.h_no_roughness)
+
+    def save(self,path):
+        np.savez_compressed(path,v=self.v,z=self.z,h=self.h,indptr=self.indptr,max_error=self.max_error,
+                            h_no_roughness=self.h_no_roughness)
+
+    @classmethod
+    def load(cls,path):
+        with np.load(path) as f:
+            return cls(f['v'],f['z'],f['h'],float(f['max_error']),float(f['h_no_roughness']),
+                       f['indptr'] if 'indptr' in f else None)
+
+cost_parameters={'eta_b':0.8,'eta_i':0.9,'F_ls':0.2,'F_os':0.15,'F_g':0,'N_d':2,'SoC_min':0.5,
+                 'I_f':0.376032308415008,'lifetime':20}
+# systems of the notebook as changes of cost_parameters: off-grid (battery) and grid-tied, where the grid takes
+# all the production that is not consumed directly (F_g=1-F_ls, no storage)
+cost_systems={'offgrid':{},'grid':{'F_os':0,'F_g':0.8}}
+
+def system_parameters(system,**params):
+    # all the cost_parameters of a system (name of cost_systems, or dict of some cost_parameters, e.g. a hybrid
+    # system with the caller's own F_os, F_g and N_d), some of them replaced by params
+    # the fractions F_ls, F_os and F_g of the production must be non-negative and add up to at most 1
+    p=dict(cost_parameters)
+    p.update(cost_systems[system] if isinstance(system,str) else system)
+    p.update(params)
+    if min(p['F_ls'],p['F_os'],p['F_g'])<0 or p['F_ls']+p['F_os']+p['F_g']>1+1e-9:
+        raise ValueError('F_ls=%r, F_os=%r and F_g=%r must be non-negative and add up to at most 1'
+                         % (p['F_ls'],p['F_os'],p['F_g']))
+    return p
+
+def cost_expressions(aep_poly,bat_fit,bat_score_fit,tow_score_fit,kwh_score_fit):
+    # sympy model of the off-grid, grid-tied and hybrid systems: (symbols, quantities) with the symbols
+    # (h, V_r, z_0, h_r) and cost_parameters, the quantities E_n, C_bat, m_bat, I_b, I_t, I_kwh, I_g, f_c and the
+    # derivatives df_c, d2f_c in h
+    # energy split of the article (eq. 5): E_n = E_p*eta_i*(F_ls + F_s*eta_b + F_g), storage F_s=1-F_ls-F_os-F_g;
+    # battery sized on N_d days of the needs times the stored share F_s/(F_s+F_g) of the production that is neither
+    # used directly nor dumped (1 off-grid, the grid covering the rest in hybrid systems), none when F_s<=1e-9
+    # (rounding of the fractions); grid energy E_p*eta_i*F_g*365*lifetime when F_g>0
+    import sympy as sp
+    h,V_r,z_0,h_r=sp.symbols('h V_r z_0 h_r',positive=True)
+    p={name:sp.Symbol(name,real=True) for name in cost_parameters}
+    def poly(coeffs,x):
+        return sum(float(c)*x**i for i,c in enumerate(np.asarray(coeffs)[::-1]))
+    V_h=V_r*sp.log(h/z_0)/sp.log(h_r/z_0)
+    E_p=poly(aep_poly,V_h)/365
+    F_s=1-p['F_ls']-p['F_os']-p['F_g']
+    storage=F_s>1e-9
+    E_n=E_p*p['eta_i']*(p['F_ls']+F_s*p['eta_b']+p['F_g'])
+    C=p['N_d']*E_n/(p['SoC_min']*p['eta_i'])*F_s/(F_s+p['F_g'])
+    C_bat=sp.Piecewise((C,storage),(0,True))
+    m_bat=sp.Piecewise((poly(bat_fit,C),storage),(0,True))
+    I_b=sp.Piecewise((poly(bat_score_fit,poly(bat_fit,C)),storage),(0,True))
+    I_t=poly(tow_score_fit,h)
+    I_kwh=sp.Piecewise((poly(kwh_score_fit,E_p*p['eta_i']*p['F_g']*365*p['lifetime']),p['F_g']>0),(0,True))
+    I_g=p['I_f']+I_b+I_t+I_kwh
+    f_c=I_g/(E_n*365*p['lifetime'])
+    symbols=[h,V_r,z_0,h_r]+[p[name] for name in cost_parameters]
+    return symbols,{'E_n':E_n,'C_bat':C_bat,'m_bat':m_bat,'I_b':I_b,'I_t':I_t,'I_kwh':I_kwh,'I_g':I_g,'f_c':f_c,
+                    'df_c':sp.diff(f_c,h),'d2f_c':sp.diff(f_c,h,2)}
+
+def coefficients_hash(*coefficients):
+    return hashlib.sha256(repr([np.asarray(c,dtype=float).tolist() for c in coefficients]).encode()).hexdigest()
+
+def cost_module(path,aep_poly,bat_fit,bat_score_fit,tow_score_fit,kwh_score_fit):
+    # numpy module of the cost functions, generated from the sympy model at path (e.g. 'data/cost_functions.py')
+    # only when the fitted coefficients, the parameter table or the model differ from the ones it was written for,
+    # and imported; functions <quantity>(h,V_r,z_0,h_r,<cost_parameters>) for the quantities of cost_expressions, and
+    # <quantity>_<system>(h,V_r,z_0,h_r,**system_parameters(system)) for the systems of cost_systems;
+    # the written module only needs numpy
+    import inspect
+    digest=hashlib.sha256((coefficients_hash(aep_poly,bat_fit,bat_score_fit,tow_score_fit,kwh_score_fit)+
+                           repr((cost_parameters,cost_systems))+inspect.getsource(cost_expressions)).encode()).hexdigest()
+    header='COEFFICIENTS_HASH = %r\n'%digest
+    current=False
+    if os.path.exists(path):
+        with open(path) as f:
+            current=header in f.read()
+    if not current:
+        import sympy as sp
+        printer=sp.printing.numpy.NumPyPrinter()
+        lines=['# generated by mylib.cost_module from the fitted coefficients, do not edit','import numpy','',header]
+        symbols,quantities=cost_expressions(aep_poly,bat_fit,bat_score_fit,tow_score_fit,kwh_score_fit)
+        arguments=', '.join(str(s) for s in symbols)
+        for quantity,expression in quantities.items():
+            lines.append('def %s(%s):'%(quantity,arguments))
+            subexpressions,(reduced,)=sp.cse(expression)
+            for symbol,subexpression in subexpressions:
+                lines.append('    %s = %s'%(symbol,printer.doprint(subexpression)))
+            lines+=['    return %s'%printer.doprint(reduced),'']
+        for system in cost_systems:
+            defaults=', '.join('%s=%r'%item for item in system_parameters(system).items())
+            for quantity in quantities:
+                lines+=['def %s_%s(h, V_r, z_0, h_r, %s):'%(quantity,system,defaults),
+                        '    return %s(%s)'%(quantity,arguments),'']
+        os.makedirs(os.path.dirname(path) or '.',exist_ok=True)
+        with open(path,'w') as f:
+            f.write('\n'.join(lines))
+    spec=importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0],path)
+    module=importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def lifetime_energy(registry,name,v_ref,h_ref,z_0,lifetime=20,k=2):
+    # FU_numeric of the eco-optimization notebook as a vectorized function FU(h,d) (kWh over the lifetime)
+    # for the rotor name of a PowerCurveRegistry (register_table of AEP_df) at the site (v_ref, h_ref, z_0)
+    def FU(h,d):
+        return registry.aep(name,d,h,v_ref,h_ref,z_0,k)/1000*lifetime
+    return FU
+
+def algebraic_impacts(model,methods,**params):
+    # vectorized impacts I(h,d) of an lca_algebraic model, shape (*h.shape, methods): one compute_impacts
+    # call with the list of (h,d) values of the whole batch instead of one call per point
+    import lca_algebraic as agb
+    def impacts(h,d):
+        h,d=np.broadcast_arrays(np.asarray(h,dtype=float),np.asarray(d,dtype=float))
+        df=agb.compute_impacts(model,methods,h=list(h.ravel()),d=list(d.ravel()),**params)
+        return df.to_numpy().reshape(h.shape+(len(methods),))
+    return impacts
+
+def algebraic_score(model,methods,NF,WF,**params):
+    # vectorized EF single score S(h,d) of an lca_algebraic model (see algebraic_impacts)
+    impacts=algebraic_impacts(model,methods,**params)
+    def score(h,d):
+        return (impacts(h,d)/NF*WF).sum(axis=-1)
+    return score
+
+def optimize_height_diameter(score,FU,h_bounds=(12,30),d_bounds=(1800,4200),n_h=19,n_d=25,
+                             levels=4,n_refine=9,energy_need=None,need_tol=0.05,start=None):
+    # minimum of the single score per kWh score(h,d)/FU(h,d) over heights h (m) and diameters d (mm),
+    # score and FU being vectorized: a coarse (n_h x n_d) grid, then levels local grids of n_refine x n_refine
+    # points spanning the neighbour cells of the current best point
+    # energy_need (kWh over the lifetime): only (h,d) producing it within need_tol are feasible
+    # start (h,d): warm start, e.g. the optimum of the previous need of the site; the whole coarse grid is still
+    # evaluated, the refinement is also run around start and the better of the two optima is kept
+    # returns a dict with h, d, score_kwh, score, energy (nan if nothing is feasible) and surface, the
+    # coarse grid of score per kWh (DataFrame, heights x diameters, nan where infeasible)
+    def evaluate(h,d):
+        H,D=np.meshgrid(h,d,indexing='ij')
+        s=np.broadcast_to(score(H,D),H.shape)
+        e=np.broadcast_to(FU(H,D),H.shape)
+        f=s/e
+        if energy_need is not None:
+            f=np.where(np.abs(e-energy_need)<=need_tol*energy_need,f,np.nan)
+        return H,D,s,e,f
+
+    def refine(best,step_h,step_d):
+        for level in range(levels):
+            h=np.linspace(max(h_bounds[0],best['h']-step_h),min(h_bounds[1],best['h']+step_h),n_refine)
+            d=np.linspace(max(d_bounds[0],best['d']-step_d),min(d_bounds[1],best['d']+step_d),n_refine)
+            step_h,step_d=h[1]-h[0],d[1]-d[0]
+            H,D,s,e,f=evaluate(h,d)
+            if np.all(np.isnan(f)):
+                break
+            i=np.nanargmin(f)
+            if np.isnan(best['score_kwh']) or f.flat[i]<=best['score_kwh']:
+                best={'h':H.flat[i],'d':D.flat[i],'score_kwh':f.flat[i],'score':s.flat[i],'energy':e.flat[i]}
+        return best
+
+    h=np.linspace(*h_bounds,n_h)
+    d=np.linspace(*d_bounds,n_d)
+    H,D,s,e,f=evaluate(h,d)
+    surface=pd.DataFrame(f,index=h,columns=d)
+    none={'h':np.nan,'d':np.nan,'score_kwh':np.nan,'score':np.nan,'energy':np.nan}
+    seeds=[]
+    if not np.all(np.isnan(f)):
+        i=np.nanargmin(f)
+        seeds.append({'h':H.flat[i],'d':D.flat[i],'score_kwh':f.flat[i],'score':s.flat[i],'energy':e.flat[i]})
+    if start is not None:
+        seeds.append(dict(none,h=start[0],d=start[1]))
+    best=none
+    for seed in seeds:
+        candidate=refine(seed,h[1]-h[0],d[1]-d[0])
+        if np.isnan(best['score_kwh']) or candidate['score_kwh']<best['score_kwh']:
+            best=candidate
+    best=dict(best)
+    best['surface']=surface
+    return best
+
+batch_problem=None
+
+def batch_worker_init(score,registry,name,options):
+    global batch_problem
+    batch_problem=(score,registry,name,options)
+
+def optimize_chunk(chunk):
+    # need-constrained optima of a chunk of problems (rows of optimize_sites), in a pool worker;
+    # consecutive problems of the same site start from the previous optimum
+    score,registry,name,options=batch_problem
+    rows=[]
+    start=None
+    previous_site=None
+    for p in chunk:
+        if p['site']!=previous_site:
+            start=None
+        FU=lifetime_energy(registry,name,p['v_ref'],p['h_ref'],p['z_0'],options.get('lifetime',20))
+        kwargs={k:v for k,v in options.items() if k!='lifetime'}
+        best=optimize_height_diameter(score,FU,energy_need=p['NrjNeed'],start=start,**kwargs)
+        rows.append({'site':p['site'],'v_ref':p['v_ref'],'z_0':p['z_0'],'h':best['h'],'d':best['d'],'NrjNeed':p['NrjNeed'],
+                     'Production':best['energy'],'SingleScore/kWh':best['score_kwh'],'Single score (absolute)':best['score']})
+        start=None if np.isnan(best['h']) else (best['h'],best['d'])
+        previous_site=p['site']
+    return rows
+
+def optimize_sites(sites,annual_needs,score,registry,name,path=None,h_ref=12.0,lifetime=20,processes=None,
+                   sites_per_chunk=8,**optimizer_kwargs):
+    # need-constrained (h,d) optimum (optimize_height_diameter) of every site x annual need, on a process pool
+    # sites: DataFrame with v_ref and z_0 columns (and h_ref, else h_ref for all); annual_needs in kWh/year
+    # each chunk holds all the needs of sites_per_chunk sites, solved in increasing order with warm starts
+    # score is sent to the workers: it has to be picklable where processes are spawned rather than forked
+    # rows are streamed to the parquet file path (one row group per chunk) as chunks complete; returns all
+    # the rows in the columns of result_optimneed_df, with site, v_ref and z_0
+    sites=sites.reset_index(drop=True)
+    problems=[{'site':i,'v_ref':float(site['v_ref']),'z_0':float(site['z_0']),'h_ref':float(site.get('h_ref',h_ref)),
+               'NrjNeed':need*lifetime} for i,site in sites.iterrows() for need in sorted(annual_needs)]
+    per_chunk=sites_per_chunk*len(annual_needs)
+    chunks=[problems[i:i+per_chunk] for i in range(0,len(problems),per_chunk)]
+    options=dict(optimizer_kwargs,lifetime=lifetime)
+    writer=None
+    results=[]
+    try:
+        with ProcessPoolExecutor(processes,initializer=batch_worker_init,initargs=(score,registry,name,options)) as pool:
+            futures=[pool.submit(optimize_chunk,chunk) for chunk in chunks]
+            for future in as_completed(futures):
+                df=pd.DataFrame(future.result())
+                results.append(df)
+                if path is not None:
+                    import pyarrow as pa
+                    import pyarrow.parquet as pq
+                    table=pa.Table.from_pandas(df,preserve_index=False)
+                    if writer is None:
+                        writer=pq.ParquetWriter(path,table.schema)
+                    writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if not results:
+        return pd.DataFrame()
+    return pd.concat(results,ignore_index=True).sort_values(['site','NrjNeed'],ignore_index=True)
+
+class SystemCostModel:
+    # numeric model of the height optimization for off-grid (battery), grid-tied and hybrid systems: the functions
+    # of cost_module (the sympy model of cost_expressions) for several configurations at once, a configuration
+    # being a system of cost_systems or a dict of cost_parameters (see system_parameters)
+    quantities=['E_n','C_bat','m_bat','I_b','I_t','I_kwh','I_g','f_c']
+
+    def __init__(self,aep_poly,bat_fit,bat_score_fit,tow_score_fit,kwh_score_fit,path='data/cost_functions.py'):
+        self.module=cost_module(path,aep_poly,bat_fit,bat_score_fit,tow_score_fit,kwh_score_fit)
+
+    def evaluate(self,h,V_r,z_0,h_r=10,configurations=('offgrid','grid'),quantities=None):
+        # quantities (default: all but the derivatives) of every configuration for broadcast arrays h, V_r, z_0:
+        # arrays of shape (configurations, *sites)
+        configs=[system_parameters(c) for c in configurations]
+        shape=np.broadcast_shapes(np.shape(h),np.shape(V_r),np.shape(z_0))
+        p={k:np.array([c[k] for c in configs],dtype=float).reshape((-1,)+(1,)*len(shape)) for k in cost_parameters}
+        return {q:np.broadcast_to(getattr(self.module,q)(h,V_r,z_0,h_r,**p),(len(configs),)+shape)
+                for q in quantities or self.quantities}
 
+    def h_opt(self,V_r,z_0,h_r=10,configuration='offgrid',h_min=12,h_max=30,tol=1e-3):
+        # optimal height in [h_min,h_max] of broadcast arrays of sites for one configuration, from df_c and d2f_c
+        # (see bracketed_minimize), e.g. HOptSurface.build(lambda V,Z:model.h_opt(V,Z,configuration='grid'),z0_values)
+        p=system_parameters(configuration)
+        V_r,z_0=np.broadcast_arrays(np.asarray(V_r,dtype=float),np.asarray(z_0,dtype=float))
+        lo=np.full(V_r.shape,float(h_min))
+        return bracketed_minimize(lambda x:self.module.df_c(x,V_r,z_0,h_r,**p),
+                                  lambda x:self.module.d2f_c(x,V_r,z_0,h_r,**p),lo,float(h_max),tol)
 
+def non_dominated(F):
+    # indices of the non-dominated rows of F (points x objectives, all minimized), duplicates kept once
+    # points are visited by increasing sum of objectives, so the next remaining one is never dominated and
+    # only removes the points it dominates
+    F=np.asarray(F,dtype=float)
+    index=np.argsort(F.sum(axis=1),kind='stable')
+    F=F[index]
+    k=0
+    while k<len(F):
+        keep=np.any(F<F[k],axis=1)
+        keep[k]=True
+        index,F=index[keep],F[keep]
+        k=np.sum(keep[:k])+1
+    return np.sort(index)
 
+def pareto_front(impacts,FU,methods,h_bounds=(12,30),d_bounds=(1800,4200),n_h=61,n_d=61,objectives=None,
+                 NF=None,WF=None,energy_need=None,need_tol=0.05):
+    # trade-offs between impact categories per kWh over a (h,d) grid, from one vectorized evaluation of
+    # impacts(h,d) (shape (*h.shape, methods), e.g. algebraic_impacts) and FU(h,d) (kWh, e.g. lifetime_energy)
+    # objectives: indices of the methods compared (all by default); energy_need restricts the grid as in
+    # optimize_height_diameter
+    # returns the non-dominated points: h, d, energy, the impact of every method per kWh (columns methods[i][1])
+    # and the EF single score per kWh when NF and WF are given
+    H,D=np.meshgrid(np.linspace(*h_bounds,n_h),np.linspace(*d_bounds,n_d),indexing='ij')
+    E=np.broadcast_to(FU(H,D),H.shape).ravel()
+    I=np.asarray(impacts(H,D)).reshape(H.size,len(methods))/E[:,None]
+    feasible=np.all(np.isfinite(I),axis=1)
+    if energy_need is not None:
+        feasible&=np.abs(E-energy_need)<=need_tol*energy_need
+    points=np.where(feasible)[0]
+    objectives=list(range(len(methods))) if objectives is None else list(objectives)
+    front=points[non_dominated(I[points][:,objectives])]
+    df=pd.DataFrame(I[front],columns=[m[1] for m in methods])
+    df.insert(0,'energy',E[front])
+    df.insert(0,'d',D.ravel()[front])
+    df.insert(0,'h',H.ravel()[front])
+    if NF is not None:
+        df['single_score']=np.sum(I[front]/NF*WF,axis=1)
+    return df.reset_index(drop=True)